@@ -1,6 +1,5 @@
 import atexit
 import gc
-import json
 import os
 import shutil
 import tempfile
@@ -9,6 +8,7 @@ from random import randrange
 from tempfile import mkdtemp
 
 import pandas as pd
+import torch
 import yaml
 
 from rlrd.util import partial, save_json, partial_to_dict, partial_from_dict, load_json, dump, load, git_info
@@ -23,9 +23,14 @@ import rlrd.envs
 def iterate_episodes(run_cls: type = Training, checkpoint_path: str = None):
     """Generator [1] yielding episode statistics (list of pd.Series) while running and checkpointing
     - run_cls: can by any callable that outputs an appropriate run object (e.g. has a 'run_epoch' method)
+    A checkpoint is saved after every epoch. It is reloaded at every epoch only with `RLRD_REINCARNATE=1 python ...`,
+    which makes uninterrupted runs behave exactly like interrupted and resumed runs, at the cost of a full pickle round trip per epoch.
 
     [1] https://docs.python.org/3/howto/functional.html#generators
     """
+    rank = init_distributed()
+    if checkpoint_path and rank > 0:
+        checkpoint_path += f"_rank{rank}"  # each process has its own environment and replay memory
     checkpoint_path = checkpoint_path or tempfile.mktemp("_remove_on_exit")
 
     try:
@@ -45,16 +50,31 @@ def iterate_episodes(run_cls: type = Training, checkpoint_path: str = None):
             print("")
             dump(run_instance, checkpoint_path)
 
-            # we delete and reload the run_instance from disk to ensure the exact same code runs regardless of interruptions
-            del run_instance
-            gc.collect()
-            run_instance = load(checkpoint_path)
+            if os.environ.get('RLRD_REINCARNATE', '0') == '1':
+                # we delete and reload the run_instance from disk to ensure the exact same code runs regardless of interruptions
+                # (this unpickles the whole replay memory every epoch, so by default the run continues from the in-memory instance)
+                del run_instance
+                gc.collect()
+                run_instance = load(checkpoint_path)
 
     finally:
         if checkpoint_path.endswith("_remove_on_exit") and exists(checkpoint_path):
             os.remove(checkpoint_path)
 
 
+def init_distributed():
+    """initializes the default process group if this process has been launched as one of several (e.g. `torchrun --nproc_per_node=4 ...`), returns the rank of this process
+    The agents that support it (e.g. rlrd.dcac.Agent) then average their gradients over all processes.
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1 or not torch.distributed.is_available():
+        return 0
+    if not torch.distributed.is_initialized():
+        if torch.cuda.is_available():
+            torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))  # device="cuda" is then this process' gpu
+        torch.distributed.init_process_group('nccl' if torch.cuda.is_available() else 'gloo')
+    return torch.distributed.get_rank()
+
+
 def log_environment_variables():
     """add certain relevant environment variables to our config
     usage: `LOG_VARIABLES='HOME JOBID' python ...`
@@ -68,6 +88,8 @@ def run(run_cls: type = Training, checkpoint_path: str = None):
 
 def run_wandb(entity, project, run_id, run_cls: type = Training, checkpoint_path: str = None):
     """run and save config and stats to https://wandb.com"""
+    if init_distributed() > 0:  # only the first process logs
+        return run(run_cls, checkpoint_path)
     wandb_dir = mkdtemp()  # prevent wandb from polluting the home directory
     atexit.register(shutil.rmtree, wandb_dir, ignore_errors=True)  # clean up after wandb atexit handler finishes
     import wandb
@@ -78,19 +100,26 @@ def run_wandb(entity, project, run_id, run_cls: type = Training, checkpoint_path
     resume = checkpoint_path and exists(checkpoint_path)
     wandb.init(dir=wandb_dir, entity=entity, project=project, id=run_id, resume=resume, config=config)
     for stats in iterate_episodes(run_cls, checkpoint_path):
-        [wandb.log(json.loads(s.to_json())) for s in stats]
+        for s in stats:
+            wandb.log({k: loggable(v) for k, v in s.items()})
+
+
+def loggable(x):
+    """converts a stats value to a plain python scalar, the way `pd.Series.to_json` would encode it (but without the round trip through a json string)"""
+    if isinstance(x, pd.Timedelta):
+        return x // pd.Timedelta(milliseconds=1)
+    return x.item() if hasattr(x, 'item') else x  # numpy scalars and tensors
 
 
 def run_fs(path: str, run_cls: type = Training):
-    """run and save config and stats to `path` (with pickle)"""
-    if not exists(path):
-        os.mkdir(path)
+    """run and save config and stats to `path` (the state is pickled, the stats are appended to `path/stats.jsonl`)"""
+    os.makedirs(path, exist_ok=True)
+    if init_distributed() > 0:  # only the first process logs
+        return run(run_cls, path + '/state')
     save_json(partial_to_dict(run_cls), path + '/spec.json')
-    if not exists(path + '/stats'):
-        dump(pd.DataFrame(), path + '/stats')
     for stats in iterate_episodes(run_cls, path + '/state'):
-        dump(load(path + '/stats').append(stats, ignore_index=True),
-             path + '/stats')  # concat with stats from previous episodes
+        with open(path + '/stats.jsonl', 'a', encoding='utf-8') as f:  # one json object per row, read with pd.read_json(path + '/stats.jsonl', lines=True)
+            f.writelines(s.to_json() + '\n' for s in stats)
 
 
 # === specifications ===================================================================================================
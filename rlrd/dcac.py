@@ -2,13 +2,14 @@
 
 from copy import deepcopy
 from dataclasses import dataclass
-from functools import reduce
+import weakref
+import numpy as np
 import torch
 from torch.nn.functional import mse_loss
 import rlrd.sac
-from rlrd.memory import TrajMemoryNoHidden
-from rlrd.nn import no_grad, exponential_moving_average
-from rlrd.util import partial
+from rlrd.memory import TrajMemoryNoHidden, CudaPrefetcher, valid_windows
+from rlrd.nn import no_grad, exponential_moving_average, CudaGraph, distributed, broadcast_, all_reduce_mean_, set_capturable
+from rlrd.util import partial, cached_property
 from rlrd.dcac_models import Mlp
 from rlrd.envs import RandomDelayEnv
 from rlrd import Training
@@ -19,6 +20,20 @@ class Agent(rlrd.sac.Agent):
     Model: type = Mlp
     loss_alpha: float = 0.2
     rtac: bool = False
+    cuda_graph: bool = False  # capture the training step in a CUDA graph (only on cuda devices, and not with distributed training)
+    amp: bool = False  # mixed precision: forward passes and losses in bfloat16 autocast (distributions, value targets and losses stay float32)
+    compile: str = ""  # torch.compile mode for the loss (e.g. "default" or "max-autotune-no-cudagraphs", requires torch>=2.0), "" to run it eagerly
+    memory_dtype: str = "float32"  # precision in which observations and actions are stored in the replay memory (e.g. "float16"), they are trained on as float32
+
+    # not pickled, it is captured again after loading (the graph only holds a weak proxy of the agent, otherwise the agent would never be freed since cached_property drops values only when their instance dies)
+    train_step_graph = cached_property(lambda self: CudaGraph(partial(type(self).train_step, weakref.proxy(self))))
+    memory_prefetcher = cached_property(lambda self: CudaPrefetcher(self.memory))  # not pickled
+    compiled_loss = cached_property(lambda self: torch.compile(partial(type(self).loss, weakref.proxy(self)), mode=self.compile))  # not pickled, it is compiled again after loading (weak proxy, see above)
+
+    @property
+    def use_cuda_graph(self):
+        """whether the training step runs as a CUDA graph (the gradient all-reduce isn't captured and compiling with mode="reduce-overhead" already uses CUDA graphs)"""
+        return self.cuda_graph and torch.device(self.device).type == "cuda" and not distributed() and self.compile != "reduce-overhead"
 
     def __post_init__(self, Env):
         with Env() as env:
@@ -34,13 +49,16 @@ class Agent(rlrd.sac.Agent):
         device = self.device  # or ("cuda" if torch.cuda.is_available() else "cpu")
         model = self.Model(observation_space, action_space)
         self.model = model.to(device)
+        if distributed():  # each process has its own environment and replay memory, the models are kept identical by averaging the gradients
+            broadcast_(self.model.parameters())
         self.model_target = no_grad(deepcopy(self.model))
 
         self.outputnorm = self.OutputNorm(self.model.critic_output_layers)
         self.outputnorm_target = self.OutputNorm(self.model_target.critic_output_layers)
 
-        self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.lr)
-        self.memory = TrajMemoryNoHidden(self.memory_size, self.batchsize, device, history=self.act_buf_size)
+        self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.lr, capturable=self.use_cuda_graph)  # the optimizer step is part of the CUDA graph
+        self.memory = TrajMemoryNoHidden(self.memory_size, self.batchsize, device, history=self.act_buf_size, dtype=self.memory_dtype)
+        valid_windows(np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64), 0)  # compiles the sampling routine now if numba is installed
         self.traj_new_actions = [None, ] * self.act_buf_size
         self.traj_new_actions_detach = [None, ] * self.act_buf_size
         self.traj_new_actions_log_prob = [None, ] * self.act_buf_size
@@ -52,13 +70,52 @@ class Agent(rlrd.sac.Agent):
     def train(self):
         # sample a trajectory of length self.act_buf_size
         # NB: when terminals is True, the terminal augmented state is the last one of the trajectory (this is ensured by the sampling procedure)
-        augm_obs_traj, act_traj, rew_traj, terminals = self.memory.sample()
+        is_cuda = torch.device(self.device).type == "cuda"
+        batch = self.memory_prefetcher.sample() if is_cuda else self.memory.sample()
         # TODO: act_traj is useless, it could be removed from the replay memory
 
+        use_cuda_graph = self.use_cuda_graph
+        set_capturable(self.optimizer, use_cuda_graph)  # e.g. after resuming a checkpoint of a distributed run in a single process
+        if use_cuda_graph:
+            stats = {k: v.clone() for k, v in self.train_step_graph(*batch).items()}
+        else:
+            stats = self.train_step(*batch)
+
+        # update target model
+        exponential_moving_average(self.model_target.parameters(), self.model.parameters(), self.target_update)
+
+        # exponential_moving_average(self.outputnorm_target.parameters(), self.outputnorm.parameters(), self.target_update)  # this is for trying PopArt in the future
+
+        return dict(
+            **stats,
+            memory_size=len(self.memory),
+        )
+
+    def train_step(self, *batch):
+        """one optimizer step, this doesn't synchronize with the host so that it can be captured in a CUDA graph"""
+        device_type = torch.device(self.device).type
+        capturing = device_type == "cuda" and torch.cuda.is_current_stream_capturing()
+        with torch.autocast(device_type, dtype=torch.bfloat16, enabled=self.amp, cache_enabled=not capturing):  # the cast weights can't be cached across CUDA graph replays
+            loss_total, loss_critic, loss_actor = (self.compiled_loss if self.compile else self.loss)(*batch)
+
+        # update model
+        self.optimizer.zero_grad(set_to_none=True)  # gradients are then allocated in the private memory pool of the CUDA graph
+        loss_total.backward()
+        if distributed():
+            all_reduce_mean_(p.grad for p in self.model.parameters())
+        self.optimizer.step()
+
+        return dict(
+            loss_total=loss_total.detach(),
+            loss_critic=loss_critic.detach(),
+            loss_actor=loss_actor.detach(),
+        )
+
+    def loss(self, augm_obs_traj, act_traj, rew_traj, terminals):
         batch_size = terminals.shape[0]
 
-        # value of the first augmented state:
-        values = [c(augm_obs_traj[0]).squeeze() for c in self.model.critics]
+        # value of the first augmented state (critic outputs are cast to float32 since they are bfloat16 with amp):
+        values = torch.stack([c(augm_obs_traj[0]).squeeze() for c in self.model.critics]).float()  # shape = (num_critics, batchsize)
 
         # nstep_len is the number of valid transitions of the sampled sub-trajectory, not counting the first one which is always valid since we consider the action delay to be always >= 1.
         # nstep_len will be e.g. 0 in the rtrl setting (an action delay of 0 here means an action delay of 1 in the paper).
@@ -74,15 +131,22 @@ class Agent(rlrd.sac.Agent):
                 tot_del = obs_del + act_del
                 # TODO: the last iteration is useless
                 nstep_len = torch.where((tot_del <= i), ones_tens * (i - 1), nstep_len)
-            nstep_max_len = torch.max(nstep_len)
-            nstep_min_len = torch.min(nstep_len)
-            assert nstep_min_len >= 0, "Each total delay must be at least 1 (instantaneous turn-based RL not supported)"
-            nstep_one_hot = torch.zeros(len(nstep_len), nstep_max_len + 1, device=self.device, requires_grad=False).scatter_(1, nstep_len.unsqueeze(1).long(), 1.)
+            if not (terminals.is_cuda and torch.cuda.is_current_stream_capturing()):  # this check synchronizes with the host
+                assert torch.min(nstep_len) >= 0, "Each total delay must be at least 1 (instantaneous turn-based RL not supported)"
         else:  # RTAC is equivalent to doing only 1-step backups (i.e. nstep_len==0)
             nstep_len = torch.zeros(batch_size, device=self.device, dtype=int_tens_type, requires_grad=False)
-            nstep_max_len = torch.max(nstep_len)
-            nstep_one_hot = torch.zeros(len(nstep_len), nstep_max_len + 1, device=self.device, requires_grad=False).scatter_(1, nstep_len.unsqueeze(1).long(), 1.)
             terminals = terminals if self.act_buf_size == 1 else terminals * 0.0  # the way the replay memory works, RTAC will never encounter terminal states for buffers of more than 1 action
+        nstep_max_len = torch.max(nstep_len)
+
+        # The n-step backups are computed for the whole trajectory at once (rather than by a backward recursion over the trajectory):
+        # backup = sum_{i <= nstep_len} discount^i * x_i + discount^(nstep_len + 1) * (bootstrap_value + x_{nstep_len + 1} if nstep_len < nstep_max_len)
+        # (the last term is how the recursion treats sub-trajectories that are shorter than the longest one of the batch)
+        # backup_weights[b, i] is the weight of x_i in the backup of the b-th element of the batch:
+        steps = torch.arange(self.act_buf_size, device=self.device)
+        nstep_len_col = nstep_len.unsqueeze(1)
+        backup_mask = (steps <= nstep_len_col) | ((steps == nstep_len_col + 1) & (steps <= nstep_max_len))
+        backup_weights = backup_mask * self.discount ** steps  # shape = (batchsize, act_buf_size)
+        bootstrap_discount = self.discount ** (nstep_len + 1)
 
         # use the current policy to compute a new trajectory of actions of length self.act_buf_size
         for i in range(self.act_buf_size + 1):
@@ -107,64 +171,46 @@ class Agent(rlrd.sac.Agent):
         # We expect each augmented state to be of shape (obs:tensor, act_buf:(tensor, ..., tensor), obs_del:tensor, act_del:tensor). Each tensor is batched.
         # To execute only 1 forward pass in the state-value estimator we recreate an artificially batched augmented state for this specific purpose.
 
-        obs_s = torch.stack([self.traj_new_augm_obs[i + 1][0][ibatch] for ibatch, i in enumerate(nstep_len)])
-        act_s = tuple(torch.stack([self.traj_new_augm_obs[i + 1][1][iact][ibatch] for ibatch, i in enumerate(nstep_len)]) for iact in range(self.old_act_buf_size))
-        od_s = torch.stack([self.traj_new_augm_obs[i + 1][2][ibatch] for ibatch, i in enumerate(nstep_len)])
-        ad_s = torch.stack([self.traj_new_augm_obs[i + 1][3][ibatch] for ibatch, i in enumerate(nstep_len)])
+        # For each element of the batch, we gather the augmented state at position nstep_len + 1 in the trajectory.
+
+        traj_idx = nstep_len.long()
+        batch_idx = torch.arange(batch_size, device=self.device)
+        next_augm_obs = self.traj_new_augm_obs[1:]
+        obs_s = torch.stack([augm_obs[0] for augm_obs in next_augm_obs])[traj_idx, batch_idx]
+        act_s = tuple(torch.stack([augm_obs[1][iact] for augm_obs in next_augm_obs])[traj_idx, batch_idx] for iact in range(self.old_act_buf_size))
+        od_s = torch.stack([augm_obs[2] for augm_obs in next_augm_obs])[traj_idx, batch_idx]
+        ad_s = torch.stack([augm_obs[3] for augm_obs in next_augm_obs])[traj_idx, batch_idx]
         mod_augm_obs = tuple((obs_s, act_s, od_s, ad_s))
 
-        with torch.no_grad():
+        with torch.inference_mode():  # no autograd bookkeeping at all (not even version counters) for the target network
 
             # These are the delayed state-value estimates we are looking for:
             target_mod_val = [c(mod_augm_obs) for c in self.model_target.critics]
-            target_mod_val = reduce(torch.min, torch.stack(target_mod_val)).squeeze()  # minimum target estimate
+            target_mod_val = torch.stack(target_mod_val).amin(0).squeeze().float()  # minimum target estimate
             target_mod_val = target_mod_val * (1. - terminals)
 
             # Now let us use this to compute the state-value targets of the batch of initial augmented states:
 
-            value_target = torch.zeros(batch_size, device=self.device)
-            backup_started = torch.zeros(batch_size, device=self.device)
-            for i in reversed(range(nstep_max_len + 1)):
-                start_backup_mask = nstep_one_hot[:, i]
-                backup_started += start_backup_mask
-                value_target = self.reward_scale * rew_traj[i] - self.entropy_scale * self.traj_new_actions_log_prob_detach[i] + backup_started * self.discount * (value_target + start_backup_mask * target_mod_val)
+            rewards = self.reward_scale * torch.stack(rew_traj, 1) - self.entropy_scale * torch.stack(self.traj_new_actions_log_prob_detach, 1)
+            value_target = (backup_weights * rewards).sum(1) + bootstrap_discount * target_mod_val
+        value_target = value_target.clone()  # inference tensors can't be saved for backward (by mse_loss)
 
         assert values[0].shape == value_target.shape, f"values[0].shape : {values[0].shape} != value_target.shape : {value_target.shape}"
         assert not value_target.requires_grad
 
         # Now the critic loss is:
 
-        loss_critic = sum(mse_loss(v, value_target) for v in values)
+        loss_critic = mse_loss(values, value_target.expand_as(values), reduction='none').mean(1).sum()  # sum over critics of their mean squared errors
 
         # actor loss:
-        # TODO: there is probably a way of merging this with the previous for loop
 
         model_mod_val = [c(mod_augm_obs) for c in self.model_nograd.critics]
-        model_mod_val = reduce(torch.min, torch.stack(model_mod_val)).squeeze()  # minimum model estimate
+        model_mod_val = torch.stack(model_mod_val).amin(0).squeeze().float()  # minimum model estimate
         model_mod_val = model_mod_val * (1. - terminals)
 
-        loss_actor = torch.zeros(batch_size, device=self.device)
-        backup_started = torch.zeros(batch_size, device=self.device)
-        for i in reversed(range(nstep_max_len + 1)):
-            start_backup_mask = nstep_one_hot[:, i]
-            backup_started += start_backup_mask
-            loss_actor = - self.entropy_scale * self.traj_new_actions_log_prob[i] + backup_started * self.discount * (loss_actor + start_backup_mask * model_mod_val)
+        entropy_rewards = - self.entropy_scale * torch.stack(self.traj_new_actions_log_prob, 1)
+        loss_actor = (backup_weights * entropy_rewards).sum(1) + bootstrap_discount * model_mod_val
         loss_actor = - loss_actor.mean(0)
 
-        # update model
-        self.optimizer.zero_grad()
         loss_total = self.loss_alpha * loss_actor + (1 - self.loss_alpha) * loss_critic
-        loss_total.backward()
-        self.optimizer.step()
-
-        # update target model
-        exponential_moving_average(self.model_target.parameters(), self.model.parameters(), self.target_update)
-
-        # exponential_moving_average(self.outputnorm_target.parameters(), self.outputnorm.parameters(), self.target_update)  # this is for trying PopArt in the future
-
-        return dict(
-            loss_total=loss_total.detach(),
-            loss_critic=loss_critic.detach(),
-            loss_actor=loss_actor.detach(),
-            memory_size=len(self.memory),
-        )
+        return loss_total, loss_critic, loss_actor
@@ -2,7 +2,7 @@ import gym
 import torch
 from torch.nn import Linear, Sequential, ReLU, ModuleList, Module
 from rlrd.sac_models import ActorModule
-from rlrd.nn import TanhNormalLayer
+from rlrd.nn import TanhNormalLayer, delayed_linear
 from rlrd.envs import RandomDelayEnv
 
 
@@ -33,28 +33,36 @@ class DelayedMlpModule(Module):
         self.act_dim = observation_space[1][0].shape[0]
         assert self.act_dim == action_space.shape[0], f"action spaces mismatch: {self.act_dim} and {action_space.shape[0]}"
         if self.act_delay and self.obs_delay:
-            self.lin = Linear(self.obs_dim + (self.act_dim + 2) * self.buf_size, hidden_units)
+            self.input_dim = self.obs_dim + (self.act_dim + 2) * self.buf_size
         elif self.act_delay or self.obs_delay:
-            self.lin = Linear(self.obs_dim + (self.act_dim + 1) * self.buf_size, hidden_units)
+            self.input_dim = self.obs_dim + (self.act_dim + 1) * self.buf_size
         else:
-            self.lin = Linear(self.obs_dim + self.act_dim * self.buf_size, hidden_units)
+            self.input_dim = self.obs_dim + self.act_dim * self.buf_size
+        self.lin = Linear(self.input_dim, hidden_units)
+        # lookup table for the one-hot delays, it is constant: being non-persistent it is not in the state_dict, so copies of the module (e.g. copy_shared) have their own
+        self.register_buffer("eye", torch.eye(self.buf_size), persistent=False)
 
-    def forward(self, x):
-        assert isinstance(x, tuple), f"x is not a tuple: {x}"
-        obs = x[0]
-        act_buf = torch.cat(x[1], dim=1)
-        input = torch.cat((obs, act_buf), dim=1)
-        batch_size = obs.shape[0]
-        if self.obs_delay:
-            obs_del = x[2]
-            obs_one_hot = torch.zeros(batch_size, self.buf_size, device=input.device).scatter_(1, obs_del.unsqueeze(1).long(), 1.0)
-            input = torch.cat((input, obs_one_hot), dim=1)
-        if self.act_delay:
-            act_del = x[3]
-            act_one_hot = torch.zeros(batch_size, self.buf_size, device=input.device).scatter_(1, act_del.unsqueeze(1).long(), 1.0)
-            input = torch.cat((input, act_one_hot), dim=1)
-        h = self.lin(input)
-        return h
+        # the forward pass is specialized once here rather than branching on the delay options at every call
+        if self.obs_delay and self.act_delay:
+            self.forward = self._forward_obs_act_delays
+        elif self.obs_delay:
+            self.forward = self._forward_obs_delay
+        elif self.act_delay:
+            self.forward = self._forward_act_delay
+        else:
+            self.forward = self._forward_no_delay
+
+    def _forward_obs_act_delays(self, x):
+        return delayed_linear(self.lin.weight, self.lin.bias, self.eye, x[0], list(x[1]), x[2], x[3], None)
+
+    def _forward_obs_delay(self, x):
+        return delayed_linear(self.lin.weight, self.lin.bias, self.eye, x[0], list(x[1]), x[2], None, None)
+
+    def _forward_act_delay(self, x):
+        return delayed_linear(self.lin.weight, self.lin.bias, self.eye, x[0], list(x[1]), None, x[3], None)
+
+    def _forward_no_delay(self, x):
+        return delayed_linear(self.lin.weight, self.lin.bias, self.eye, x[0], list(x[1]), None, None, None)
 
 
 class MlpStateValue(Sequential):
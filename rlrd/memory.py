@@ -1,6 +1,14 @@
 from collections import deque
 from random import randint
-from rlrd.util import collate
+import numpy as np
+import torch
+from rlrd.util import collate, to_device
+from rlrd.nn import record_stream
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional (pip install rlrd[numba])
+    njit = None
 
 
 class Memory:
@@ -48,8 +56,8 @@ class Memory:
     def sample(self, indices=None):
         indices = self.sample_indices() if indices is None else indices
         batch = [self.memory[idx] for idx in indices]
-        batch = collate(batch, self.device)
-        return batch
+        obs, action, r, next_obs, done = collate(batch, self.device)
+        return obs, action, r.float(), next_obs, done.float()  # rewards and terminals are stored as they come from the environment
 
 
 class TrajMemory:
@@ -98,45 +106,155 @@ class TrajMemory:
 
 
 class TrajMemoryNoHidden:
+    """Replay memory of sub-trajectories of `history + 1` consecutive steps
+    Each step is stored only once, in preallocated numpy arrays (ring buffers) with one array per leaf of the observation and action structures.
+    A batch of sub-trajectories is gathered with a single indexing operation per array.
+    """
     keep_reset_transitions: int = 0
 
-    def __init__(self, memory_size, batchsize, device, history=1, remove_size=100):
+    def __init__(self, memory_size, batchsize, device, history=1, dtype=np.float32):
+        """
+        Args:
+            memory_size: number of steps that can be stored
+            history: number of steps of a sub-trajectory after its first step
+            dtype: numpy dtype in which the floating point arrays of the observations and actions are stored (e.g. np.float16 to halve the memory footprint), they are sampled as float32 tensors
+        """
         self.device = device
         self.batchsize = batchsize
         self.capacity = memory_size
-        self.memory = []  # list is much faster to index than deque for big sizes
-        self.history = deque(maxlen=history + 1)
-        self.remove_size = remove_size
+        self.history = history
+        self.dtype = np.dtype(dtype)
+
+        self.steps = 0  # total number of steps appended so far
+        self.windows = 0  # number of sub-trajectories currently stored
+        # consecutive steps that belong to the same segment can be sampled together (a segment ends with a terminal or reset step)
+        self.segment = 0
+        self.segment_len = 0
+
+        self.obs_structure = None
+        self.action_structure = None
+        self.obs_buf = None  # one array per leaf of the observation structure
+        self.action_buf = None  # one array per leaf of the action structure
+        self.r_buf = np.empty(memory_size, dtype=np.float32)
+        self.d_buf = np.empty(memory_size, dtype=np.float32)
+        self.segment_buf = np.empty(memory_size, dtype=np.int64)
+
+    def allocate(self, leaves):
+        return [np.empty((self.capacity, *np.shape(x)), dtype=self.dtype if np.issubdtype(np.asarray(x).dtype, np.floating) else np.asarray(x).dtype) for x in leaves]
 
     def append(self, r, done, info, obs, action):
-        self.history.append((r, obs, action))
-        if not self.keep_reset_transitions and (info.get('TimeLimit.truncated', False) or info.get('reset', False)):
-            self.history.clear()
-
-        if len(self.history) == self.history.maxlen:
-            (_, *r), m, a = zip(*self.history)
-            self.memory.append((m, a, r, done))
-
-        if done:
-            self.history.clear()
-
-        # remove old entries if necessary (delete generously so we don't have to do it often)
-        if len(self.memory) > self.capacity:
-            del self.memory[:self.capacity // self.remove_size + 1]
+        if self.obs_buf is None:
+            self.obs_structure, self.action_structure = obs, action
+            self.obs_buf, self.action_buf = self.allocate(flatten(obs)), self.allocate(flatten(action))
+
+        reset = not self.keep_reset_transitions and (info.get('TimeLimit.truncated', False) or info.get('reset', False))
+        if reset:  # this step doesn't belong to any sub-trajectory
+            self.segment += 1
+            self.segment_len = 0
+        else:
+            self.segment_len += 1
+
+        idx = self.steps % self.capacity
+        if self.steps >= self.capacity and self.is_valid(np.array([idx]))[0]:
+            self.windows -= 1  # the oldest sub-trajectory is overwritten
+
+        for buf, x in zip(self.obs_buf, flatten(obs)):
+            buf[idx] = x
+        for buf, x in zip(self.action_buf, flatten(action)):
+            buf[idx] = x
+        self.r_buf[idx] = r
+        self.d_buf[idx] = done
+        self.segment_buf[idx] = self.segment
+        self.steps += 1
+
+        if self.segment_len > self.history:
+            self.windows += 1  # a new sub-trajectory ends with this step
+
+        if reset or done:
+            self.segment += 1
+            self.segment_len = 0
 
         return self
 
     def __len__(self):
-        return len(self.memory)
+        return self.windows
 
-    def __getitem__(self, item):
-        return self.memory[item]
+    def is_valid(self, indices):
+        """whether the sub-trajectories starting at indices are made of steps of a single segment"""
+        return valid_windows(self.segment_buf, indices, self.history)
 
     def sample_indices(self):
-        return (randint(0, len(self.memory) - 1) for _ in range(self.batchsize))
-
-    def sample(self, indices=None):
+        """uniformly samples the indices of the first steps of stored sub-trajectories"""
+        assert self.windows > 0, "no sub-trajectory has been stored yet"
+        low, high = self.steps - min(self.steps, self.capacity), self.steps - self.history  # sub-trajectories start in [low, high)
+        indices = np.random.randint(low, high, size=self.batchsize) % self.capacity
+        invalid = ~self.is_valid(indices)
+        while invalid.any():  # resample sub-trajectories that span several segments
+            indices[invalid] = np.random.randint(low, high, size=invalid.sum()) % self.capacity
+            invalid = ~self.is_valid(indices)
+        return indices
+
+    def sample(self, indices=None, pin_memory=False):
         indices = self.sample_indices() if indices is None else indices
-        batch = [self.memory[idx] for idx in indices]
-        batch = collate(batch, self.device)
+        traj_indices = (indices + np.arange(self.history + 1)[:, None]) % self.capacity  # shape = (history + 1, batchsize)
+
+        def gather(buf, traj_idx):
+            x = to_device(torch.from_numpy(buf[traj_idx]), self.device, pin_memory)
+            return x.float() if x.is_floating_point() else x  # the cast happens after the transfer to the device
+
+        obs = [gather(buf, traj_indices).unbind(0) for buf in self.obs_buf]
+        action = [gather(buf, traj_indices).unbind(0) for buf in self.action_buf]
+        m = tuple(unflatten(self.obs_structure, iter(leaves)) for leaves in zip(*obs))
+        a = tuple(unflatten(self.action_structure, iter(leaves)) for leaves in zip(*action))
+        r = gather(self.r_buf, traj_indices[1:]).unbind(0)  # the reward of the first step is not part of the sub-trajectory
+        done = gather(self.d_buf, traj_indices[-1])
+        return m, a, r, done
+
+
+def _valid_windows_numpy(segments, starts, history):
+    """whether the windows of `history + 1` steps starting at `starts` in the ring buffer of segment ids `segments` don't cross a segment boundary"""
+    return segments[starts] == segments[(starts + history) % len(segments)]
+
+
+def _valid_windows_loop(segments, starts, history):
+    """same as `_valid_windows_numpy` without the temporary arrays, to be compiled with numba"""
+    capacity = len(segments)
+    valid = np.empty(len(starts), dtype=np.bool_)
+    for i in range(len(starts)):
+        valid[i] = segments[starts[i]] == segments[(starts[i] + history) % capacity]
+    return valid
+
+
+valid_windows = njit(cache=True)(_valid_windows_loop) if njit is not None else _valid_windows_numpy
+
+
+def flatten(x):
+    """returns the leaves of a nested tuple structure"""
+    return [leaf for elem in x for leaf in flatten(elem)] if isinstance(x, tuple) else [x]
+
+
+def unflatten(structure, leaves):
+    """builds a nested tuple structure like `structure` from an iterator over leaves"""
+    return tuple(unflatten(elem, leaves) for elem in structure) if isinstance(structure, tuple) else next(leaves)
+
+
+class CudaPrefetcher:
+    """Samples batches from a replay memory one step ahead: the next batch is copied to the cuda device on a side stream from page-locked memory while the current batch is being used"""
+
+    def __init__(self, memory):
+        self.memory = memory
+        self.stream = torch.cuda.Stream()
+        self.next_batch = None
+
+    def sample(self):
+        if self.next_batch is None:
+            self.next_batch = self.sample_async()
+        torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.next_batch
+        record_stream(batch, torch.cuda.current_stream())  # batch has been allocated on self.stream
+        self.next_batch = self.sample_async()
         return batch
+
+    def sample_async(self):
+        with torch.cuda.stream(self.stream):
+            return self.memory.sample(pin_memory=True)
@@ -1,14 +1,18 @@
 from copy import deepcopy
 from dataclasses import InitVar, dataclass
+from typing import List, Optional
 
 import numpy as np
 import torch
+from torch import Tensor
 from torch.distributions import Distribution, Normal
 from torch.nn import Module
+from torch.nn import functional as F
 from torch.nn.init import kaiming_uniform_, xavier_uniform_, calculate_gain
 from torch.nn.parameter import Parameter
 
 from rlrd import partial
+from rlrd.util import no_gc
 
 
 def detach(x):
@@ -18,6 +22,32 @@ def detach(x):
         return [detach(elem) for elem in x]
 
 
+def clone(x):
+    """clones a nested structure of tensors"""
+    if isinstance(x, torch.Tensor):
+        return x.clone()
+    else:
+        return type(x)(clone(elem) for elem in x)
+
+
+def copy_(dst, src):
+    """copies a nested structure of tensors into another one with the same structure (in-place)"""
+    if isinstance(dst, torch.Tensor):
+        dst.copy_(src)
+    else:
+        for d, s in zip(dst, src):
+            copy_(d, s)
+
+
+def record_stream(x, stream):
+    """marks a nested structure of cuda tensors as used by `stream` (e.g. when they have been allocated on another stream)"""
+    if isinstance(x, torch.Tensor):
+        x.record_stream(stream)
+    else:
+        for elem in x:
+            record_stream(elem, stream)
+
+
 def no_grad(model):
     for p in model.parameters():
         p.requires_grad = False
@@ -30,6 +60,40 @@ def exponential_moving_average(averages, values, factor):
             a += factor * (v - a)  # equivalent to a = (1-factor) * a + factor * v
 
 
+def distributed():
+    """whether this process is one of several training processes (see `rlrd.init_distributed`)"""
+    return torch.distributed.is_available() and torch.distributed.is_initialized() and torch.distributed.get_world_size() > 1
+
+
+def broadcast_(tensors, src=0):
+    """overwrites tensors with the ones of process `src`, e.g. so that all processes start from the same parameters"""
+    with torch.no_grad():
+        for t in tensors:
+            torch.distributed.broadcast(t, src)
+
+
+def all_reduce_mean_(tensors):
+    """averages tensors over all processes, in a single collective operation"""
+    tensors = [t for t in tensors if t is not None]
+    flat = torch.cat([t.reshape(-1) for t in tensors])
+    torch.distributed.all_reduce(flat)
+    flat /= torch.distributed.get_world_size()
+    for t, mean in zip(tensors, flat.split([t.numel() for t in tensors])):
+        t.copy_(mean.view_as(t))
+
+
+def set_capturable(optimizer, capturable: bool):
+    """makes an optimizer (e.g. Adam) capturable in a CUDA graph or not, its step counters are then on the device of the parameters or on the cpu"""
+    for group in optimizer.param_groups:
+        if group.get('capturable', False) == capturable:
+            continue
+        group['capturable'] = capturable
+        for p in group['params']:
+            state = optimizer.state.get(p, {})
+            if torch.is_tensor(state.get('step')):
+                state['step'] = state['step'].to(p.device if capturable else 'cpu')
+
+
 def copy_shared(model_a):
     """Create a deepcopy of a model but with the underlying state_dict shared. E.g. useful in combination with `no_grad`."""
     model_b = deepcopy(model_a)
@@ -42,6 +106,44 @@ def copy_shared(model_a):
     return model_b
 
 
+class CudaGraph:
+    """Runs a function as a CUDA graph [1] to get rid of the kernel launch overhead
+    The first `warmup` calls run eagerly on a side stream. Then, `func` is captured once and the graph is replayed for every subsequent call with the inputs copied into static tensors.
+    The garbage collector is paused during warmup and capture since collections there slow down the capture considerably.
+    NB: `func` must not synchronize with the host and the outputs are static tensors that are overwritten by the next call.
+
+    [1] https://pytorch.org/docs/stable/notes/cuda.html#cuda-graphs
+    """
+
+    def __init__(self, func, warmup: int = 3):
+        self.func = func
+        self.warmup = warmup
+        self.calls = 0
+        self.stream = torch.cuda.Stream()
+        self.graph = None
+        self.static_inputs = None
+        self.static_outputs = None
+
+    def __call__(self, *inputs):
+        if self.calls < self.warmup:
+            self.calls += 1
+            self.stream.wait_stream(torch.cuda.current_stream())
+            with no_gc(), torch.cuda.stream(self.stream):
+                outputs = self.func(*inputs)
+            torch.cuda.current_stream().wait_stream(self.stream)
+            return outputs
+
+        if self.graph is None:
+            self.static_inputs = clone(inputs)
+            self.graph = torch.cuda.CUDAGraph()
+            with no_gc(), torch.cuda.graph(self.graph):
+                self.static_outputs = self.func(*self.static_inputs)
+
+        copy_(self.static_inputs, inputs)
+        self.graph.replay()
+        return self.static_outputs
+
+
 class PopArt(Module):
     """PopArt http://papers.nips.cc/paper/6076-learning-values-across-many-orders-of-magnitude"""
 
@@ -65,18 +167,19 @@ class PopArt(Module):
         beta = max(1 / (self.updates + 1), self.beta) if self.zero_debias else self.beta
         # note that for beta = 1/self.updates the resulting mean, std would be the true mean and std over all past data
 
-        new_mean = (1 - beta) * self.mean + beta * targets.mean(0)
-        new_mean_square = (1 - beta) * self.mean_square + beta * (targets * targets).mean(0)
-        new_std = (new_mean_square - new_mean * new_mean).sqrt().clamp(0.0001, 1e6)
+        new_mean = torch.lerp(self.mean, targets.mean(0), beta)
+        new_mean_square = torch.lerp(self.mean_square, targets.square().mean(0), beta)
+        new_std = torch.addcmul(new_mean_square, new_mean, new_mean, value=-1).sqrt_().clamp_(0.0001, 1e6)
 
         # assert self.std.shape == (1,), 'this has only been tested in 1D'
 
         if self.updates >= self.start_pop:
+            # the outputs y = w x + b of the layers are changed to (y * std + mean - new_mean) / new_std, the scale and shift are the same for all layers:
+            scale = self.std / new_std
+            shift = (self.mean - new_mean) / new_std
             for layer in self.output_layers:
-                layer.weight *= (self.std / new_std)[:, None]
-                layer.bias *= self.std
-                layer.bias += self.mean - new_mean
-                layer.bias /= new_std
+                layer.weight.mul_(scale[:, None])
+                layer.bias.mul_(scale).add_(shift)
 
         self.mean.copy_(new_mean)
         self.mean_square.copy_(new_mean_square)
@@ -88,7 +191,7 @@ class PopArt(Module):
         return (x - self.mean) / self.std
 
     def unnormalize(self, x):
-        return x * self.std + self.mean
+        return torch.addcmul(self.mean, x, self.std)
 
     def normalize_sum(self, s):
         """normalize x.sum(1) preserving relative weightings between elements"""
@@ -104,9 +207,9 @@ class TanhNormal(Distribution):
     def __init__(self, normal_mean, normal_std, epsilon=1e-6):
         self.normal_mean = normal_mean
         self.normal_std = normal_std
-        self.normal = Normal(normal_mean, normal_std)
+        self.normal = Normal(normal_mean, normal_std, validate_args=False)  # validation would synchronize with the host
         self.epsilon = epsilon
-        super().__init__(self.normal.batch_shape, self.normal.event_shape)
+        super().__init__(self.normal.batch_shape, self.normal.event_shape, validate_args=False)
 
     def log_prob(self, x):
         if hasattr(x, "pre_tanh_value"):
@@ -148,15 +251,29 @@ class TanhNormalLayer(torch.nn.Module):
         self.lin_std.bias.data.uniform_(-1e-3, 1e-3)
 
     def forward(self, x):
-        mean = self.lin_mean(x)
-        log_std = self.lin_std(x)
+        # the distribution is always float32 (e.g. under bfloat16 autocast the log-probabilities would be too imprecise)
+        mean = self.lin_mean(x).float()
+        log_std = self.lin_std(x).float()
         log_std = torch.clamp(log_std, -20, 2)
         std = torch.exp(log_std)
         # a = TanhTransformedDist(Independent(Normal(m, std), 1))
-        a = Independent(TanhNormal(mean, std), 1)
+        a = Independent(TanhNormal(mean, std), 1, validate_args=False)
         return a
 
 
+@torch.jit.script
+def delayed_linear(weight: Tensor, bias: Tensor, eye: Tensor, obs: Tensor, act_buf: List[Tensor], obs_del: Optional[Tensor], act_del: Optional[Tensor], act: Optional[Tensor]):
+    """linear layer applied to the concatenation of an augmented observation (with one-hot delays, rows of `eye`) and optionally an action"""
+    parts = [obs] + act_buf
+    if obs_del is not None:
+        parts.append(F.embedding(obs_del, eye))
+    if act_del is not None:
+        parts.append(F.embedding(act_del, eye))
+    if act is not None:
+        parts.append(act)
+    return F.linear(torch.cat(parts, dim=1), weight, bias)
+
+
 class RlkitLinear(torch.nn.Linear):
     def __init__(self, *args):
         super().__init__(*args)
@@ -1,9 +1,8 @@
 from collections import deque
 from copy import deepcopy, copy
 from dataclasses import dataclass, InitVar
-from functools import lru_cache, reduce
+from functools import lru_cache
 from itertools import chain
-import numpy as np
 import torch
 from torch.nn.functional import mse_loss
 
@@ -56,7 +55,7 @@ class Agent:
         action, next_state, _ = self.model.act(state, obs, r, done, info, train)
 
         if train:
-            self.memory.append(np.float32(r), np.float32(done), info, obs, action)
+            self.memory.append(r, done, info, obs, action)
             self.environment_steps += 1
 
             total_updates_target = (self.environment_steps - self.start_training) * self.training_steps
@@ -76,7 +75,7 @@ class Agent:
         next_action_distribution = self.model_nograd.actor(next_obs)  # outputs distribution object
         next_actions = next_action_distribution.sample()  # samples
         next_value = [c(next_obs, next_actions) for c in self.model_target.critics]
-        next_value = reduce(torch.min, next_value)  # minimum action-value
+        next_value = torch.stack(next_value).amin(0)  # minimum action-value
         next_value = self.outputnorm_target.unnormalize(next_value)  # PopArt (not present in the original paper)
         # next_value = self.outputnorm.unnormalize(next_value)  # PopArt (not present in the original paper)
 
@@ -101,7 +100,7 @@ class Agent:
 
         # actor loss
         new_value = [c(obs, new_actions) for c in self.model.critics]  # new_actions with reparametrization trick
-        new_value = reduce(torch.min, new_value)  # minimum action_values
+        new_value = torch.stack(new_value).amin(0)  # minimum action_values
         assert new_value.shape == (self.batchsize, 2)
 
         new_value = self.outputnorm.unnormalize(new_value)
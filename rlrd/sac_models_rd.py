@@ -4,7 +4,7 @@ import torch
 from torch.nn import Linear, Sequential, ReLU, ModuleList, Module
 from torch.nn import functional as F
 from rlrd.sac_models import ActorModule
-from rlrd.nn import TanhNormalLayer
+from rlrd.nn import TanhNormalLayer, delayed_linear
 
 from rlrd.envs import RandomDelayEnv
 
@@ -48,69 +48,62 @@ class DelayedMlpModule(Module):
         self.act_dim = observation_space[1][0].shape[0]
         assert self.act_dim == action_space.shape[0], f"action spaces mismatch: {self.act_dim} and {action_space.shape[0]}"
 
+        if self.tbmdp:
+            self.input_dim = self.obs_dim
+        elif self.act_delay and self.obs_delay:
+            self.input_dim = self.obs_dim + (self.act_dim + 2) * self.buf_size
+        elif self.act_delay or self.obs_delay:
+            self.input_dim = self.obs_dim + (self.act_dim + 1) * self.buf_size
+        else:
+            self.input_dim = self.obs_dim + self.act_dim * self.buf_size
         if self.is_Q_network:
-            if self.tbmdp:
-                self.lin = Linear(self.obs_dim + self.act_dim, hidden_units)
-            elif self.act_delay and self.obs_delay:
-                self.lin = Linear(self.obs_dim + (self.act_dim + 2) * self.buf_size + self.act_dim, hidden_units)
-            elif self.act_delay or self.obs_delay:
-                self.lin = Linear(self.obs_dim + (self.act_dim + 1) * self.buf_size + self.act_dim, hidden_units)
-            else:
-                self.lin = Linear(self.obs_dim + self.act_dim * self.buf_size + self.act_dim, hidden_units)
+            self.input_dim += self.act_dim
+        self.lin = Linear(self.input_dim, hidden_units)
+        # lookup table for the one-hot delays, it is constant: being non-persistent it is not in the state_dict, so copies of the module (e.g. copy_shared) have their own
+        self.register_buffer("eye", torch.eye(self.buf_size), persistent=False)
+
+        # the forward pass is specialized once here rather than branching on the options at every call
+        # (the last element of a Q-network's input is the action)
+        if self.tbmdp:
+            self.forward = self._forward_q_tbmdp if self.is_Q_network else self._forward_tbmdp
+        elif self.obs_delay and self.act_delay:
+            self.forward = self._forward_q_obs_act_delays if self.is_Q_network else self._forward_obs_act_delays
+        elif self.obs_delay:
+            self.forward = self._forward_q_obs_delay if self.is_Q_network else self._forward_obs_delay
+        elif self.act_delay:
+            self.forward = self._forward_q_act_delay if self.is_Q_network else self._forward_act_delay
         else:
-            if self.tbmdp:
-                self.lin = Linear(self.obs_dim, hidden_units)
-            elif self.act_delay and self.obs_delay:
-                self.lin = Linear(self.obs_dim + (self.act_dim + 2) * self.buf_size, hidden_units)
-            elif self.act_delay or self.obs_delay:
-                self.lin = Linear(self.obs_dim + (self.act_dim + 1) * self.buf_size, hidden_units)
-            else:
-                self.lin = Linear(self.obs_dim + self.act_dim * self.buf_size, hidden_units)
-
-    def forward(self, x):
-        assert isinstance(x, tuple), f"x is not a tuple: {x}"
-        # TODO: check that x is actually in:
-        # Tuple((
-        # 	obs_space,  # most recent observation
-        # 	Tuple([act_space] * (obs_delay_range.stop + act_delay_range.stop)),  # action buffer
-        # 	Discrete(obs_delay_range.stop),  # observation delay int64
-        # 	Discrete(act_delay_range.stop),  # kappa int64
-        #   Discrete(act_delay_range.stop+1),  # beta int64 (not used by the model)
-        # ))
+            self.forward = self._forward_q_no_delay if self.is_Q_network else self._forward_no_delay
 
-        # TODO: double check that everything is correct (dims, devices, autograd)
-        # TODO: triple check devices...
+    def _forward_tbmdp(self, x):
+        return delayed_linear(self.lin.weight, self.lin.bias, self.eye, x[0], [], None, None, None)
 
-        obs = x[0]
+    def _forward_obs_act_delays(self, x):
+        return delayed_linear(self.lin.weight, self.lin.bias, self.eye, x[0], list(x[1]), x[2], x[3], None)
 
-        if self.tbmdp:
-            input = obs
-            if self.is_Q_network:
-                act = x[5]
-                input = torch.cat((input, act), dim=1)
-            h = self.lin(input)
-            return h
-
-        act_buf = torch.cat(x[1], dim=1)
-
-        input = torch.cat((obs, act_buf), dim=1)
-
-        batch_size = obs.shape[0]
-        if self.obs_delay:
-            obs_del = x[2]
-            obs_one_hot = torch.zeros(batch_size, self.buf_size, device=input.device).scatter_(1, obs_del.unsqueeze(1).long(), 1.0)
-            input = torch.cat((input, obs_one_hot), dim=1)
-        if self.act_delay:
-            act_del = x[3]
-            act_one_hot = torch.zeros(batch_size, self.buf_size, device=input.device).scatter_(1, act_del.unsqueeze(1).long(), 1.0)
-            input = torch.cat((input, act_one_hot), dim=1)
-        if self.is_Q_network:
-            act = x[5]
-            input = torch.cat((input, act), dim=1)
+    def _forward_obs_delay(self, x):
+        return delayed_linear(self.lin.weight, self.lin.bias, self.eye, x[0], list(x[1]), x[2], None, None)
+
+    def _forward_act_delay(self, x):
+        return delayed_linear(self.lin.weight, self.lin.bias, self.eye, x[0], list(x[1]), None, x[3], None)
+
+    def _forward_no_delay(self, x):
+        return delayed_linear(self.lin.weight, self.lin.bias, self.eye, x[0], list(x[1]), None, None, None)
+
+    def _forward_q_tbmdp(self, x):
+        return delayed_linear(self.lin.weight, self.lin.bias, self.eye, x[0], [], None, None, x[5])
+
+    def _forward_q_obs_act_delays(self, x):
+        return delayed_linear(self.lin.weight, self.lin.bias, self.eye, x[0], list(x[1]), x[2], x[3], x[5])
+
+    def _forward_q_obs_delay(self, x):
+        return delayed_linear(self.lin.weight, self.lin.bias, self.eye, x[0], list(x[1]), x[2], None, x[5])
 
-        h = self.lin(input)
+    def _forward_q_act_delay(self, x):
+        return delayed_linear(self.lin.weight, self.lin.bias, self.eye, x[0], list(x[1]), None, x[3], x[5])
 
-        return h
+    def _forward_q_no_delay(self, x):
+        return delayed_linear(self.lin.weight, self.lin.bias, self.eye, x[0], list(x[1]), None, None, x[5])
 
 
 class MlpActionValue(Sequential):
@@ -1,4 +1,5 @@
 import functools
+import gc
 import inspect
 import io
 import json
@@ -55,6 +56,11 @@ def collate(batch, device=None):
         return torch.from_numpy(np.array(batch)).to(device)  # we create a numpy array first to work around https://github.com/pytorch/pytorch/issues/24200
 
 
+def to_device(x: torch.Tensor, device=None, pin_memory=False):
+    """If pin_memory is True, the tensor is copied to the device asynchronously from page-locked memory"""
+    return x.pin_memory().to(device, non_blocking=True) if pin_memory else x.to(device)
+
+
 def partition(x):
     """Turns a nested structure with batched torch tensors as leaves into a batch of elements with the same nested structure and un-batched numpy arrays as leaves"""
     if isinstance(x, torch.Tensor):
@@ -226,6 +232,22 @@ def load_json(path):
         return json.load(f)
 
 
+# === garbage collection ===============================================================================================
+
+@contextmanager
+def no_gc():
+    """Disables the cyclic garbage collector and freezes the objects it currently tracks, e.g. to prevent collections from happening during a CUDA graph capture"""
+    enabled = gc.isenabled()
+    gc.disable()
+    gc.freeze()
+    try:
+        yield
+    finally:
+        gc.unfreeze()
+        if enabled:
+            gc.enable()
+
+
 # === signal handling ==================================================================================================
 
 class DelayInterrupt:
@@ -16,7 +16,7 @@ setup(
     license='MIT',
     install_requires=[
         'numpy',
-        'torch',
+        'torch>=1.12',  # capturable optimizers, bfloat16 autocast, inference mode, non-persistent buffers
         'imageio',
         'imageio-ffmpeg',
         'pandas',
@@ -25,7 +25,7 @@ setup(
         'wandb'
     ],
     extras_require={
-
+        'numba': ['numba'],
     },
     scripts=[],
     packages=find_packages()
@@ -0,0 +1,54 @@
+"""
+Checks that a DCAC agent is freed once deleted, i.e. that the values of its cached properties (e.g. the CUDA graph of the training step) don't keep it alive
+"""
+
+import gc
+import sys
+import weakref
+
+import gym
+import numpy as np
+import torch
+
+import rlrd.dcac
+from rlrd.envs import Env
+from rlrd.wrappers_rd import RandomDelayWrapper
+
+
+class TestEnv(gym.Env):
+	observation_space = gym.spaces.Box(-1, 1, shape=(3,), dtype=np.float32)
+	action_space = gym.spaces.Box(-1, 1, shape=(2,), dtype=np.float32)
+
+	def reset(self, **kwargs):
+		return self.observation_space.sample()
+
+	def step(self, action: np.ndarray):
+		return self.observation_space.sample(), float(np.sum(action)), np.random.rand() < 0.05, {}
+
+
+class TestDelayEnv(Env):
+	def __init__(self, seed_val=0):
+		super().__init__(RandomDelayWrapper(TestEnv(), range(0, 3), range(0, 2)))
+
+
+def check_agent_gc(**kwargs):
+	agent = rlrd.dcac.Agent(TestDelayEnv, device="cuda" if torch.cuda.is_available() else "cpu", batchsize=8, start_training=50, **kwargs)
+	env = TestDelayEnv()
+	state = None
+	for _ in range(60):  # a few training steps (past the warmup of the CUDA graph on cuda)
+		action, state, _ = agent.act(state, *env.transition, train=True)
+		env.step(action)
+
+	ref = weakref.ref(agent)
+	del agent
+	gc.collect()
+	assert ref() is None, f"the agent hasn't been freed ({kwargs})"
+	print("freed", kwargs)
+
+
+if __name__ == "__main__":
+	if len(sys.argv) > 1:
+		check_agent_gc(**dict(arg.split("=") for arg in sys.argv[1:]))
+	else:
+		check_agent_gc()
+		check_agent_gc(compile="default")